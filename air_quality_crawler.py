@@ -10,13 +10,90 @@
 阶段二：进入二级链接获取该城市各监测站的空气质量数据
 """
 
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import httpx
+from selectolax.lexbor import LexborHTMLParser
+import os
+import sys
+import csv
 import time
 import re
-import random
+import hashlib
+import json
+import tempfile
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 from urllib.parse import urljoin
 
+# 安装了brotli时才声明支持br压缩，否则响应无法解码
+try:
+    import brotli  # noqa: F401
+    _ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    _ACCEPT_ENCODING = "gzip, deflate"
+
+# 首页城市分组的字母标题，如"A."、"B."
+_LETTER_RE = re.compile(r"^[A-Z]\.")
+
+# 输出CSV的列名，除城市外与Station字段一一对应
+CSV_FIELDS = ["城市", "监测站", "AQI", "空气质量等级", "PM2.5", "PM10", "首要污染物"]
+
+class Station(NamedTuple):
+    """监测站空气质量数据，缺失的字段为N/A"""
+    name: str = "N/A"
+    aqi: str = "N/A"
+    level: str = "N/A"
+    pm25: str = "N/A"
+    pm10: str = "N/A"
+    pollutant: str = "N/A"
+
+# 监测站表格表头与Station字段的对应关系
+_HEADER_FIELDS = {
+    "监测站": "name",
+    "AQI": "aqi",
+    "空气质量等级": "level",
+    "PM2.5": "pm25",
+    "PM10": "pm10",
+    "首要污染物": "pollutant"
+}
+
+def _node_string(node):
+    """获取节点唯一的文本内容，与BeautifulSoup的Tag.string一致
+    
+    节点只有一个子节点时取该子节点的文本（逐层向下），
+    有多个子节点时返回空字符串。
+    
+    Args:
+        node: selectolax节点
+        
+    Returns:
+        str: 节点的文本内容
+    """
+    children = list(node.iter(include_text=True))
+    if len(children) != 1:
+        return ""
+    child = children[0]
+    if child.tag == "-text":
+        return child.text(deep=False)
+    return _node_string(child)
+
+def _header_field(header):
+    """识别监测站表格表头对应的Station字段
+    
+    表头可能带有单位或后缀，如"AQI指数"、"PM2.5(μg/m³)"，因此按前缀匹配。
+    
+    Args:
+        header: 表头文字
+        
+    Returns:
+        str: Station字段名，无法识别则返回None
+    """
+    for key, field in _HEADER_FIELDS.items():
+        if header.startswith(key):
+            return field
+    return None
+
 class AirQualityCrawler:
     def __init__(self, class_name="鸿班2201", name="崔翔", student_id="2206040013"):
         """初始化爬虫类
@@ -33,47 +110,147 @@ class AirQualityCrawler:
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
-            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8"
+            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+            # 启用压缩传输，httpx会自动解压
+            "Accept-Encoding": _ACCEPT_ENCODING
         }
         # 重试次数
         self.max_retries = 3
+        # 阶段二并发请求数
+        self.concurrency = 20
+        # 相邻两次请求的最小间隔（秒），避免请求过快被封IP
+        self.min_interval = 0.7
+        # 下一次请求最早可发出的时间（time.monotonic()）
+        self._next_earliest = 0.0
+        # 本地网页缓存目录及有效期（秒），有效期设为0则不使用缓存
+        self.cache_dir = Path(".air_cache")
+        self.cache_expire = 3600
+        # 阶段二监测站数据的CSV输出文件
+        self.output_file = "air_quality.csv"
         
-    def get_html(self, url, retries=0):
-        """获取网页HTML内容，支持重试
+    def _reserve_slot(self):
+        """预约下一次请求的发送时间，实现按最小间隔限速
+        
+        网络耗时已经超过最小间隔时无需额外等待。该方法不含await，
+        在事件循环中调用时不会被其他协程打断。
+        
+        Returns:
+            float: 发送请求前还需等待的秒数，小于等于0表示可立即发送
+        """
+        now = time.monotonic()
+        wait = self._next_earliest - now
+        self._next_earliest = max(now, self._next_earliest) + self.min_interval
+        return wait
+    
+    def _cache_path(self, key, suffix):
+        """根据缓存键计算缓存文件路径
         
         Args:
+            key: 缓存键，如URL
+            suffix: 缓存文件后缀
+            
+        Returns:
+            Path: 缓存文件路径
+        """
+        return self.cache_dir / (hashlib.sha1(key.encode("utf-8")).hexdigest() + suffix)
+    
+    def _read_cache(self, path):
+        """读取未过期的缓存文件
+        
+        Args:
+            path: 缓存文件路径
+            
+        Returns:
+            bytes: 缓存内容，未命中或已过期则返回None
+        """
+        if not self.cache_expire:
+            return None
+        try:
+            if time.time() - path.stat().st_mtime < self.cache_expire:
+                return path.read_bytes()
+        except OSError:
+            pass
+        return None
+    
+    def _write_cache(self, path, data):
+        """写入缓存文件，失败时仅打印提示
+        
+        Args:
+            path: 缓存文件路径
+            data: 缓存内容(bytes)
+        """
+        if not self.cache_expire:
+            return
+        tmp_path = None
+        try:
+            self.cache_dir.mkdir(exist_ok=True)
+            # 先写入临时文件再原子替换，避免中断或并发运行时留下写了一半的缓存
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入缓存失败: {e}，路径: {path}")
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    
+    def _create_client(self):
+        """创建httpx异步客户端，阶段一和阶段二使用相同的配置
+        
+        启用HTTP/2，所有页面在同一域名下，可在一条连接上多路复用；
+        服务器不支持时自动回退到HTTP/1.1。
+        
+        Returns:
+            httpx.AsyncClient: 异步客户端
+        """
+        limits = httpx.Limits(max_connections=self.concurrency,
+                              max_keepalive_connections=self.concurrency)
+        return httpx.AsyncClient(http2=True, headers=self.headers, timeout=10, limits=limits)
+    
+    async def fetch_front_page(self):
+        """异步获取首页HTML内容
+        
+        Returns:
+            str: 首页HTML内容，失败则返回None
+        """
+        async with self._create_client() as client:
+            return await self.fetch_html(client, self.base_url)
+    
+    async def fetch_html(self, client, url):
+        """异步获取网页HTML内容，支持重试
+        
+        Args:
+            client: httpx异步客户端
             url: 目标URL
-            retries: 当前重试次数
             
         Returns:
             str: HTML内容，失败则返回None
         """
-        try:
-            # 随机延迟0.5-1.5秒，避免请求过快被封IP
-            time.sleep(random.uniform(0.5, 1.5))
+        # 城市页面是实时的空气质量数据，不使用缓存
+        for attempt in range(self.max_retries + 1):
+            # 上一次请求失败，退避后重试
+            if attempt:
+                print(f"正在进行第 {attempt} 次重试...")
+                await asyncio.sleep(2 ** (attempt - 1))  # 指数退避策略
             
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.encoding = "utf-8"
-            if response.status_code == 200:
-                return response.text
-            else:
-                print(f"请求失败，状态码: {response.status_code}，URL: {url}")
+            try:
+                # 限速：仅在距上次请求不足最小间隔时等待
+                wait = self._reserve_slot()
+                if wait > 0:
+                    await asyncio.sleep(wait)
                 
-                # 如果请求失败且未超过最大重试次数，则重试
-                if retries < self.max_retries:
-                    print(f"正在进行第 {retries + 1} 次重试...")
-                    time.sleep(2 ** retries)  # 指数退避策略
-                    return self.get_html(url, retries + 1)
-                return None
-        except requests.exceptions.RequestException as e:
-            print(f"请求异常: {e}，URL: {url}")
-            
-            # 如果请求异常且未超过最大重试次数，则重试
-            if retries < self.max_retries:
-                print(f"正在进行第 {retries + 1} 次重试...")
-                time.sleep(2 ** retries)  # 指数退避策略
-                return self.get_html(url, retries + 1)
-            return None
+                response = await client.get(url)
+                if response.status_code == 200:
+                    # 网站固定使用utf-8编码，直接解码原始字节
+                    return response.content.decode("utf-8", errors="replace")
+                print(f"请求失败，状态码: {response.status_code}，URL: {url}")
+            except httpx.HTTPError as e:
+                print(f"请求异常: {e}，URL: {url}")
+        
+        return None
     
     def parse_cities(self, html):
         """解析首页获取所有城市及其链接
@@ -82,67 +259,86 @@ class AirQualityCrawler:
             html: 首页HTML内容
             
         Returns:
-            list: 城市信息列表，每个元素为(城市名, 链接)元组
+            list: 城市信息列表，每个元素为(城市名, 完整链接)元组
         """
         if not html:
             print("HTML内容为空，无法解析城市列表")
             return []
             
         cities = []
+        # 已添加的城市名，用于O(1)去重
+        seen = set()
         try:
-            soup = BeautifulSoup(html, "html.parser")
+            tree = LexborHTMLParser(html)
             
             # 查找所有以字母开头的段落，这些段落后面跟着城市列表
-            letter_paragraphs = soup.find_all("p", string=lambda text: text and re.match(r"^[A-Z]\.", text.strip()))
+            # 只匹配内容仅为标题文字的段落，以开头恰好是"A."的普通段落不算
+            letter_paragraphs = [p for p in tree.css("p") if _LETTER_RE.match(_node_string(p).strip())]
             
             for p in letter_paragraphs:
                 # 查找字母分类区域，它通常是一个div，包含字母标题和城市列表
                 city_section = p.parent
                 if city_section:
                     # 获取该区域内的所有链接，这些链接是城市链接
-                    city_links = city_section.find_all("a")
+                    city_links = city_section.css("a")
                     for link in city_links:
-                        city_name = link.text.strip()
-                        city_url = link["href"]
+                        city_name = link.text().strip()
+                        city_url = link.attributes["href"]
                         cities.append((city_name, city_url))
+                        seen.add(city_name)
             
             # 检查主要城市区域
-            key_cities_section = soup.find(string=lambda text: text and "重点城市" in text)
+            key_cities_section = next(
+                (node for node in tree.root.traverse(include_text=True)
+                 if node.tag == "-text" and "重点城市" in node.text()),
+                None
+            )
             if key_cities_section:
                 key_cities_parent = key_cities_section.parent
                 if key_cities_parent:
-                    # 获取重点城市区域的所有链接
-                    for a in key_cities_parent.find_next_siblings():
-                        links = a.find_all("a")
+                    # 获取重点城市区域的所有链接（遍历其后的兄弟元素节点，跳过文本和注释）
+                    # 不同版本的selectolax中css()是否包含节点自身不一致，
+                    # 因此子节点本身是链接时直接使用，否则在其后代中查找
+                    sibling = key_cities_parent.next
+                    while sibling is not None:
+                        links = []
+                        if sibling.tag not in ("-text", "-comment"):
+                            links = [link for child in sibling.iter()
+                                     for link in ([child] if child.tag == "a" else child.css("a"))]
+                        sibling = sibling.next
                         for link in links:
-                            city_name = link.text.strip()
-                            city_url = link["href"]
+                            city_name = link.text().strip()
+                            city_url = link.attributes["href"]
                             # 检查是否已经添加过该城市
-                            if not any(name == city_name for name, _ in cities):
+                            if city_name not in seen:
+                                seen.add(city_name)
                                 cities.append((city_name, city_url))
             
             # 从排行榜表格中获取城市链接
-            ranking_tables = soup.find_all("table")
+            ranking_tables = tree.css("table")
             for table in ranking_tables:
-                rows = table.find_all("tr")[1:]  # 跳过表头
+                rows = table.css("tr")[1:]  # 跳过表头
                 for row in rows:
-                    city_link = row.find("a")
+                    city_link = row.css_first("a")
                     if city_link:
-                        city_name = city_link.text.strip()
-                        city_url = city_link["href"]
+                        city_name = city_link.text().strip()
+                        city_url = city_link.attributes["href"]
                         # 检查是否已经添加过该城市
-                        if not any(name == city_name for name, _ in cities):
+                        if city_name not in seen:
+                            seen.add(city_name)
                             cities.append((city_name, city_url))
             
-            # 确保所有URL都是相对路径，以便后续拼接
-            cities = [(name, url if url.startswith("/") else f"/{url}") for name, url in cities]
+            # 确保所有URL都是相对路径，并一次性拼接成完整URL，后续阶段直接使用
+            cities = [(name, urljoin(self.base_url, url if url.startswith("/") else f"/{url}"))
+                      for name, url in cities]
             
             return cities
         except Exception as e:
             print(f"解析城市列表时发生异常: {e}")
             return []
     
-    def parse_stations(self, html, city_name):
+    @staticmethod
+    def parse_stations(html, city_name):
         """解析城市页面获取所有监测站的空气质量数据
         
         Args:
@@ -150,7 +346,7 @@ class AirQualityCrawler:
             city_name: 城市名称，用于日志输出
             
         Returns:
-            list: 监测站空气质量数据列表
+            list: 监测站空气质量数据列表，每个元素为Station
         """
         if not html:
             print(f"HTML内容为空，无法解析城市 {city_name} 的监测站数据")
@@ -158,60 +354,47 @@ class AirQualityCrawler:
             
         stations = []
         try:
-            soup = BeautifulSoup(html, "html.parser")
+            tree = LexborHTMLParser(html)
             
             # 查找监测站表格
-            tables = soup.find_all("table")
-            if not tables:
+            # 在城市页面中，通常第一个表格是监测站数据，只取第一个即可
+            # 表格结构通常是：监测站|AQI|空气质量等级|PM2.5|PM10|首要污染物
+            table = tree.css_first("table")
+            if table is None:
                 print(f"在城市 {city_name} 页面中未找到表格")
                 return stations
                 
-            # 在城市页面中，通常第一个表格是监测站数据
-            # 表格结构通常是：监测站|AQI|空气质量等级|PM2.5|PM10|首要污染物
-            table = tables[0]
-            rows = table.find_all("tr")
+            # 只遍历直接子节点，避免对整棵子树做递归查找
+            # HTML5解析时会自动补全tbody，因此行都位于thead/tbody/tfoot之下
+            rows = [row for section in table.iter() if section.tag in ("thead", "tbody", "tfoot")
+                    for row in section.iter() if row.tag == "tr"]
             
             if len(rows) <= 1:
                 print(f"城市 {city_name} 的监测站表格内容不足")
                 return stations
             
             # 提取表头，确认列的含义
-            headers = [th.text.strip() for th in rows[0].find_all(["th", "td"])]
+            headers = [th.text().strip() for th in rows[0].iter() if th.tag in ("th", "td")]
+            
+            # 确定每个Station字段所在的列：表头能识别的按表头，
+            # 其余字段按默认列顺序（监测站|AQI|空气质量等级|PM2.5|PM10|首要污染物），
+            # 默认列已被其他识别出的字段占用时该字段记为N/A
+            columns = {}
+            for i, header in enumerate(headers):
+                field = _header_field(header)
+                if field:
+                    columns[field] = i
+            claimed = set(columns.values())
+            positions = [columns.get(field, None if i in claimed else i)
+                         for i, field in enumerate(Station._fields)]
             
             # 跳过表头
             for row in rows[1:]:
-                cols = row.find_all("td")
+                cols = [col for col in row.iter() if col.tag == "td"]
                 if len(cols) >= 3:  # 确保有足够的列
-                    station_data = {}
-                    
-                    # 根据表头提取数据
-                    for i, col in enumerate(cols):
-                        if i < len(headers):  # 防止索引越界
-                            header = headers[i]
-                            value = col.text.strip()
-                            station_data[header] = value
-                    
-                    # 如果没有按表头提取到，则使用默认列名
-                    if not station_data:
-                        station_name = cols[0].text.strip()
-                        aqi = cols[1].text.strip()
-                        air_quality = cols[2].text.strip()
-                        
-                        # 提取更多数据，如果有的话
-                        pm25 = cols[3].text.strip() if len(cols) > 3 else "N/A"
-                        pm10 = cols[4].text.strip() if len(cols) > 4 else "N/A"
-                        main_pollutant = cols[5].text.strip() if len(cols) > 5 else "N/A"
-                        
-                        station_data = {
-                            "监测站": station_name,
-                            "AQI": aqi,
-                            "空气质量等级": air_quality,
-                            "PM2.5": pm25,
-                            "PM10": pm10,
-                            "首要污染物": main_pollutant
-                        }
-                    
-                    stations.append(station_data)
+                    station = Station(*[cols[i].text().strip() if i is not None and i < len(cols) else "N/A"
+                                        for i in positions])
+                    stations.append(station)
                     
             return stations
         except Exception as e:
@@ -223,14 +406,29 @@ class AirQualityCrawler:
         print(f"阶段一：{self.class_name}+{self.name}+{self.student_id}")
         print("爬取结果：")
         
-        # 获取首页HTML
-        html = self.get_html(self.base_url)
-        if not html:
-            print("获取首页失败")
-            return None
+        # 优先使用缓存的城市列表，命中时无需请求和解析首页
+        # 缓存按base_url保存，每次写入覆盖旧文件，由文件修改时间判断是否过期
+        cities_path = self._cache_path(self.base_url, ".json")
+        cities = None
+        cached = self._read_cache(cities_path)
+        if cached is not None:
+            try:
+                cities = [(name, url) for name, url in json.loads(cached.decode("utf-8"))]
+            except (ValueError, TypeError):
+                # 缓存文件损坏，视为未命中
+                cities = None
         
-        # 解析城市列表
-        cities = self.parse_cities(html)
+        if cities is None:
+            # 获取首页HTML
+            html = asyncio.run(self.fetch_front_page())
+            if not html:
+                print("获取首页失败")
+                return None
+            
+            # 解析城市列表
+            cities = self.parse_cities(html)
+            if cities:
+                self._write_cache(cities_path, json.dumps(cities, ensure_ascii=False).encode("utf-8"))
         
         if not cities:
             print("未能爬取到城市数据")
@@ -239,62 +437,109 @@ class AirQualityCrawler:
         # 显示爬取结果
         print(f"共爬取到 {len(cities)} 个城市:")
         for i, (city_name, city_url) in enumerate(cities, 1):
-            full_url = urljoin(self.base_url, city_url)
-            print(f"{i}. {city_name}: {full_url}")
+            print(f"{i}. {city_name}: {city_url}")
             
         return cities
     
+    async def fetch_and_parse(self, client, sem, pool, writer, index, total, city):
+        """异步爬取并解析单个城市的监测站数据，并逐行写入CSV
+        
+        Args:
+            client: httpx异步客户端
+            sem: 控制并发数的信号量
+            pool: 用于解析页面的进程池
+            writer: CSV写入器(csv.writer)
+            index: 城市序号，用于日志输出
+            total: 城市总数，用于日志输出
+            city: (城市名, 完整链接)元组
+            
+        Returns:
+            int: 写入的监测站数量，失败则返回0
+        """
+        city_name, city_url = city
+        
+        # 获取城市页面HTML，信号量限制同时进行的请求数
+        async with sem:
+            print(f"[{index}/{total}] 正在爬取城市: {city_name} ({city_url})")
+            html = await self.fetch_html(client, city_url)
+        if not html:
+            print(f"获取城市 {city_name} 页面失败，跳过该城市")
+            return 0
+        
+        # 解析监测站数据，放到进程池中执行以免阻塞事件循环
+        loop = asyncio.get_running_loop()
+        stations = await loop.run_in_executor(pool, self.parse_stations, html, city_name)
+        
+        if not stations:
+            print(f"未能解析到城市 {city_name} 的监测站数据")
+            return 0
+        
+        # 打印该城市的监测站数据，先拼接好整座城市的输出再一次性写出，减少系统调用
+        lines = [f"城市 {city_name} 共有 {len(stations)} 个监测站:"]
+        for j, station in enumerate(stations, 1):
+            # 构建站点信息字符串，缺失的字段为N/A
+            lines.append(f"  {j}. 站点: {station.name}, AQI: {station.aqi}, 空气质量等级: {station.level}, "
+                         f"PM2.5: {station.pm25}, PM10: {station.pm10}, 首要污染物: {station.pollutant}")
+            
+            # 写入CSV，只在事件循环线程中写入，无需加锁
+            writer.writerow((city_name, *station))
+        
+        sys.stdout.write("\n".join(lines) + "\n")
+        return len(stations)
+    
+    async def crawl_cities(self, cities, writer):
+        """并发爬取所有城市的监测站数据
+        
+        Args:
+            cities: 阶段一爬取的城市列表
+            writer: CSV写入器(csv.writer)
+            
+        Returns:
+            list: 与cities一一对应的爬取结果（写入的监测站数量或异常）
+        """
+        sem = asyncio.Semaphore(self.concurrency)
+        # 进程数使用默认值（CPU核数，Windows上不超过61）
+        with ProcessPoolExecutor() as pool:
+            async with self._create_client() as client:
+                tasks = [self.fetch_and_parse(client, sem, pool, writer, i, len(cities), city)
+                         for i, city in enumerate(cities, 1)]
+                return await asyncio.gather(*tasks, return_exceptions=True)
+    
     def crawl_phase2(self, cities):
         """阶段二：进入二级链接获取该城市各监测站的空气质量数据
         
         Args:
             cities: 阶段一爬取的城市列表
+            
+        Returns:
+            int: 写入CSV文件的监测站总数
         """
         print(f"\n阶段二：{self.class_name}+{self.name}+{self.student_id}")
         print("爬取结果：")
         
         if not cities:
             print("没有城市数据可爬取")
-            return
-        
-        all_stations = {}
+            return 0
         
         # 爬取所有城市的监测站数据
-        print(f"将爬取所有 {len(cities)} 个城市的监测站数据")
+        print(f"将并发爬取所有 {len(cities)} 个城市的监测站数据")
         
-        for i, (city_name, city_url) in enumerate(cities, 1):
-            # 构建完整URL
-            full_url = urljoin(self.base_url, city_url)
-            print(f"[{i}/{len(cities)}] 正在爬取城市: {city_name} ({full_url})")
-            
-            # 获取城市页面HTML
-            html = self.get_html(full_url)
-            if not html:
-                print(f"获取城市 {city_name} 页面失败，跳过该城市")
-                continue
-            
-            # 解析监测站数据
-            stations = self.parse_stations(html, city_name)
-            
-            if not stations:
-                print(f"未能解析到城市 {city_name} 的监测站数据")
+        # 边爬取边写入CSV，内存占用不随城市数量增长
+        # 使用utf-8-sig编码，便于Excel正确识别中文
+        with open(self.output_file, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_FIELDS)
+            results = asyncio.run(self.crawl_cities(cities, writer))
+        
+        total = 0
+        for (city_name, _), count in zip(cities, results):
+            if isinstance(count, Exception):
+                print(f"爬取城市 {city_name} 时发生异常: {count}")
                 continue
-                
-            all_stations[city_name] = stations
-            
-            # 打印该城市的监测站数据
-            print(f"城市 {city_name} 共有 {len(stations)} 个监测站:")
-            for j, station in enumerate(stations, 1):
-                # 构建站点信息字符串，处理可能缺失的字段
-                station_info = f"  {j}. 站点: {station.get('监测站', 'N/A')}"
-                
-                for key in ['AQI', '空气质量等级', 'PM2.5', 'PM10', '首要污染物']:
-                    if key in station:
-                        station_info += f", {key}: {station[key]}"
-                
-                print(station_info)
-            
-        return all_stations
+            total += count
+        
+        print(f"共 {total} 个监测站数据已写入 {self.output_file}")
+        return total
 
 def main():
     """主函数"""